@@ -1,33 +1,298 @@
+import hashlib
 import os
+import shutil
 import tempfile
-from flask import Flask, render_template, request, send_file
+import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from asgiref.wsgi import WsgiToAsgi
+from flask import Flask, Request, Response, abort, render_template, request
+from werkzeug.exceptions import HTTPException
+from werkzeug.formparser import FormDataParser, MultiPartParser
+from werkzeug.wsgi import FileWrapper
 from dd1750_core import generate_dd1750_from_pdf
 
+# Parse multipart bodies in 16 MiB chunks instead of werkzeug's 64 KiB
+# default; with 100+ MB BOM uploads the boundary search re-scans the
+# buffer far fewer times.
+MULTIPART_BUFFER_SIZE = 16 * 1024 * 1024
+
+
+class _BigBufferFormDataParser(FormDataParser):
+    def _parse_multipart(self, stream, mimetype, content_length, options):
+        parser = MultiPartParser(
+            stream_factory=self.stream_factory,
+            max_form_memory_size=self.max_form_memory_size,
+            max_form_parts=self.max_form_parts,
+            cls=self.cls,
+            buffer_size=MULTIPART_BUFFER_SIZE,
+        )
+        boundary = options.get('boundary', '').encode('ascii')
+        if not boundary:
+            raise ValueError('Missing boundary')
+        form, files = parser.parse(stream, boundary, content_length)
+        return stream, form, files
+
+
+class _BigBufferRequest(Request):
+    form_data_parser_class = _BigBufferFormDataParser
+
+
 app = Flask(__name__)
+app.request_class = _BigBufferRequest
+
+# The templates never change at runtime; skip Jinja's per-request stat.
+app.config['TEMPLATES_AUTO_RELOAD'] = False
+app.jinja_env.auto_reload = False
+
+# Reject oversize uploads from the declared Content-Length (413) before
+# werkzeug spends any CPU parsing the multipart body.
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_BYTES', 200 * 1024 * 1024))
+
+
+@app.before_request
+def _reject_oversize():
+    # MAX_CONTENT_LENGTH alone does not give clients a 413 here:
+    # werkzeug raises it at the first request.files access, which sits
+    # inside generate()'s blanket error handler. Short-circuit from the
+    # declared length before any body parsing instead.
+    length = request.content_length
+    if length is not None and length > app.config['MAX_CONTENT_LENGTH']:
+        abort(413)
+
+# ASGI entrypoint: run with
+#   uvicorn app:asgi_app --host 0.0.0.0 --port $PORT --workers $(nproc)
+# Handlers stay sync; Uvicorn runs each on a thread off the event loop so
+# upload I/O on one request never blocks the accept path.
+asgi_app = WsgiToAsgi(app)
+
+# Copy uploads to disk in 1 MiB chunks instead of werkzeug's 16 KiB
+# default; large BOM PDFs spend far fewer syscalls per request.
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+
+def _scratch_dir():
+    """Base dir for per-request temp files, preferring tmpfs.
+
+    Keeping bom/tpl/out PDFs on /dev/shm avoids three disk writes and a
+    read per request. Overridable with SCRATCH_DIR; falls back to the
+    OS temp dir when no tmpfs is available.
+    """
+    scratch = os.environ.get('SCRATCH_DIR')
+    if scratch is None and os.path.isdir('/dev/shm'):
+        scratch = '/dev/shm/dd1750'
+    if scratch:
+        os.makedirs(scratch, exist_ok=True)
+    return scratch
+
+
+SCRATCH_DIR = _scratch_dir()
+
+# The blank DD1750 template is almost always the same file across
+# requests; keep uploaded templates in a content-addressed cache so a
+# repeat upload reuses the stored copy instead of a fresh tempfile.
+# LRU-bounded like the result cache: the directory lives on tmpfs by
+# default, so distinct templates must not accumulate in RAM forever.
+TEMPLATE_CACHE_DIR = os.path.join(SCRATCH_DIR or tempfile.gettempdir(), 'template-cache')
+os.makedirs(TEMPLATE_CACHE_DIR, exist_ok=True)
+TEMPLATE_CACHE_MAX = int(os.environ.get('TEMPLATE_CACHE_MAX', 8))
+_template_cache = OrderedDict()
+_template_cache_lock = threading.Lock()
+
+
+def cache_template(file_storage):
+    """Store an uploaded template by content hash.
+
+    Returns (path, digest) so callers can key further caching off the
+    template content.
+    """
+    tpl_bytes = file_storage.read()
+    digest = hashlib.blake2b(tpl_bytes, digest_size=16).hexdigest()
+    tpl_path = os.path.join(TEMPLATE_CACHE_DIR, f'{digest}.pdf')
+    with _template_cache_lock:
+        if digest not in _template_cache:
+            # The file may predate this process (worker restart);
+            # re-adopt it rather than rewrite it.
+            if not os.path.exists(tpl_path):
+                tmp_path = tpl_path + '.tmp'
+                with open(tmp_path, 'wb') as f:
+                    f.write(tpl_bytes)
+                os.replace(tmp_path, tpl_path)
+            _template_cache[digest] = tpl_path
+        _template_cache.move_to_end(digest)
+        while len(_template_cache) > TEMPLATE_CACHE_MAX:
+            _, evicted = _template_cache.popitem(last=False)
+            try:
+                os.unlink(evicted)
+            except OSError:
+                pass
+    return tpl_path, digest
+
+
+def save_upload(file_storage, path):
+    """Stream an upload to disk, returning its content digest."""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'wb') as f:
+        while True:
+            chunk = file_storage.stream.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            h.update(chunk)
+            f.write(chunk)
+    return h.hexdigest()
+
+# When running behind nginx, set OUTPUT_DIR to a directory nginx can
+# serve and X_ACCEL_PREFIX to the matching internal location (see
+# deploy/nginx.conf); responses then go out via kernel sendfile instead
+# of Python's chunked reader. Without the env vars, send_file is used.
+OUTPUT_DIR = os.environ.get('OUTPUT_DIR')
+X_ACCEL_PREFIX = os.environ.get('X_ACCEL_PREFIX')
+RESPONSE_CHUNK_SIZE = 1 << 20
+if OUTPUT_DIR:
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+
+def _send_pdf(path, download_name):
+    if OUTPUT_DIR and X_ACCEL_PREFIX:
+        if os.path.dirname(os.path.abspath(path)) == os.path.abspath(OUTPUT_DIR):
+            final_name = os.path.basename(path)
+        else:
+            # Tempdir outputs are all named out.pdf; move them out under
+            # a unique name before the tempdir is cleaned up.
+            final_name = f'{uuid.uuid4().hex}.pdf'
+            shutil.move(path, os.path.join(OUTPUT_DIR, final_name))
+        return Response(mimetype='application/pdf', headers={
+            'X-Accel-Redirect': f'{X_ACCEL_PREFIX}/{final_name}',
+            'Content-Disposition': f'attachment; filename="{download_name}"',
+        })
+    # Stream in 1 MiB blocks through the server's file_wrapper (sendfile
+    # where the server supports it) rather than send_file's 8 KiB loop.
+    fh = open(path, 'rb')
+    wrapper = request.environ.get('wsgi.file_wrapper', FileWrapper)
+    return Response(wrapper(fh, RESPONSE_CHUNK_SIZE), mimetype='application/pdf',
+                    direct_passthrough=True, headers={
+                        'Content-Length': str(os.path.getsize(path)),
+                        'Content-Disposition': f'attachment; filename="{download_name}"',
+                    })
+
+
+# Rendered PDFs are cached by (bom, template, start_page) content key;
+# an identical resubmission skips PDF work entirely and just serves the
+# stored file. LRU-bounded, with evicted entries unlinked from disk.
+RESULT_CACHE_DIR = OUTPUT_DIR or os.path.join(SCRATCH_DIR or tempfile.gettempdir(), 'result-cache')
+os.makedirs(RESULT_CACHE_DIR, exist_ok=True)
+RESULT_CACHE_MAX = int(os.environ.get('RESULT_CACHE_MAX', 64))
+_result_cache = OrderedDict()
+_result_cache_lock = threading.Lock()
+
+
+def _result_cache_get(key):
+    with _result_cache_lock:
+        path = _result_cache.get(key)
+        if path is None:
+            return None
+        if not os.path.exists(path):
+            del _result_cache[key]
+            return None
+        _result_cache.move_to_end(key)
+        return path
+
+
+def _result_cache_put(key, out_path):
+    cached_path = os.path.join(RESULT_CACHE_DIR, f'{key}.pdf')
+    shutil.copyfile(out_path, cached_path)
+    with _result_cache_lock:
+        _result_cache[key] = cached_path
+        _result_cache.move_to_end(key)
+        while len(_result_cache) > RESULT_CACHE_MAX:
+            _, evicted = _result_cache.popitem(last=False)
+            try:
+                os.unlink(evicted)
+            except OSError:
+                pass
+    return cached_path
+
+
+# Run PDF generation in a persistent process pool so a big BOM never
+# pins the web worker; workers pre-import the PDF libs once at start.
+GENERATE_TIMEOUT = int(os.environ.get('GENERATE_TIMEOUT', 300))
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _warm_imports():
+    import dd1750_core  # noqa: F401
+
+
+def _get_executor():
+    # Created lazily so Gunicorn's preload/fork happens before the pool
+    # spawns its children.
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ProcessPoolExecutor(
+                    max_workers=int(os.environ.get('GENERATE_WORKERS', os.cpu_count() or 1)),
+                    initializer=_warm_imports,
+                )
+    return _executor
+
+
+_index_html = None
+
 
 @app.route('/')
 def index():
-    return render_template('index.html')
+    # index.html takes no template data; render once and serve the
+    # cached body afterwards.
+    global _index_html
+    if _index_html is None:
+        _index_html = render_template('index.html')
+    return _index_html
+
+def _is_pdf_name(filename):
+    # One slice + one compare; uploads always land on our own fixed
+    # paths, so the name only needs a sanity check, not sanitization.
+    return bool(filename) and filename[-4:].lower() == '.pdf'
+
 
 @app.route('/generate', methods=['POST'])
 def generate():
     try:
-        with tempfile.TemporaryDirectory() as tmpdir:
+        bom_file = request.files.get('bom_file')
+        template_file = request.files.get('template_file')
+        if bom_file is None or template_file is None:
+            return "Missing file", 400
+        if not _is_pdf_name(bom_file.filename) or not _is_pdf_name(template_file.filename):
+            return "Only PDF uploads are accepted", 400
+
+        with tempfile.TemporaryDirectory(dir=SCRATCH_DIR) as tmpdir:
             bom_path = os.path.join(tmpdir, 'bom.pdf')
-            tpl_path = os.path.join(tmpdir, 'tpl.pdf')
             out_path = os.path.join(tmpdir, 'out.pdf')
-            
-            request.files['bom_file'].save(bom_path)
-            request.files['template_file'].save(tpl_path)
-            
+
+            bom_digest = save_upload(bom_file, bom_path)
+            tpl_path, tpl_digest = cache_template(template_file)
+
             start_page = int(request.form.get('start_page', 0))
-            out_path, count = generate_dd1750_from_pdf(bom_path, tpl_path, out_path, start_page)
-            
+            cache_key = f'{bom_digest}-{tpl_digest}-{start_page}'
+            cached = _result_cache_get(cache_key)
+            if cached is not None:
+                return _send_pdf(cached, 'DD1750.pdf')
+
+            future = _get_executor().submit(
+                generate_dd1750_from_pdf, bom_path, tpl_path, out_path, start_page)
+            out_path, count = future.result(timeout=GENERATE_TIMEOUT)
+
             if count == 0:
                 return "No items found", 400
+
+            return _send_pdf(_result_cache_put(cache_key, out_path), 'DD1750.pdf')
             
-            return send_file(out_path, as_attachment=True, download_name='DD1750.pdf')
-            
+    except HTTPException:
+        # Let werkzeug's own responses (413 from the body parser, etc.)
+        # reach the client instead of rewriting them as 500s.
+        raise
     except Exception as e:
         return f"Error: {str(e)}", 500
 
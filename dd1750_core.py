@@ -1,15 +1,31 @@
 """DD1750 core."""
 
+import functools
 import io
-import math
+import logging
+import os
 import re
 from dataclasses import dataclass
-from typing import List
+from typing import List, Optional
 
 import pdfplumber
 from pypdf import PdfReader, PdfWriter
+from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfgen import canvas
 
+# PyMuPDF parses layout an order of magnitude faster than pdfplumber's
+# pure-Python analysis; use it for table extraction when installed.
+try:
+    import pymupdf
+except ImportError:
+    try:
+        import fitz as pymupdf
+    except ImportError:
+        pymupdf = None
+_HAS_PYMUPDF = pymupdf is not None and hasattr(pymupdf.Page, 'find_tables')
+
+
+logger = logging.getLogger(__name__)
 
 ROWS_PER_PAGE = 18
 PAGE_W, PAGE_H = 612.0, 792.0
@@ -26,8 +42,54 @@ Y_TABLE_BOTTOM_LINE = 89.5
 ROW_H = (Y_TABLE_TOP_LINE - Y_TABLE_BOTTOM_LINE) / ROWS_PER_PAGE
 PAD_X = 3.0
 
+# Column centres are invariant; fold the midpoint arithmetic out of the
+# per-row draw loop.
+X_BOX_C = (X_BOX_L + X_BOX_R) / 2
+X_UOI_C = (X_UOI_L + X_UOI_R) / 2
+X_INIT_C = (X_INIT_L + X_INIT_R) / 2
+X_SPARES_C = (X_SPARES_L + X_SPARES_R) / 2
+X_TOTAL_C = (X_TOTAL_L + X_TOTAL_R) / 2
+
+_LV_TOKENS = frozenset(('LV', 'LEVEL'))
+_DESC_TOKENS = frozenset(('DESC', 'DESCRIPTION', 'NOMENCLATURE'))
+_MAT_TOKENS = frozenset(('MATERIAL',))
+
+# Output PDFs are written through a 1 MiB buffer so pypdf's many small
+# object writes coalesce into few large syscalls.
+_WRITE_BUFFER_SIZE = 1 << 20
+
+_NSN_RE = re.compile(r'\b(\d{9})\b')
+_QTY_RE = re.compile(r'(\d+)')
+# One pass over the junk tail of a description: a parenthesised remark
+# (optionally preceded by a trailing catalog code) or, with no remark,
+# the trailing code alone. Equivalent to the old split-at-paren pass
+# followed by a trailing-code sub.
+_CODE = r'(?:WTY|ARC|CIIC|UI|SCMC|EA|AY|9K|9G)'
+_DESC_JUNK_RE = re.compile(rf'\s+{_CODE}\s*\(.*$|\s*\(.*$|\s+{_CODE}$', re.IGNORECASE)
+_WS_RE = re.compile(r'\s+')
+
+
+def _cell_text(cell):
+    # Backend cells are str in practice; skip str()'s type dispatch for
+    # them and convert only genuine non-strings.
+    return cell if isinstance(cell, str) else str(cell)
+
+
+@functools.lru_cache(maxsize=1024)
+def _clean_description(raw):
+    """Pick and clean the description line from a raw description cell.
+
+    BOMs repeat identical description cells across line items (same
+    part, several assemblies), so the split/sub work is memoized on the
+    raw cell text.
+    """
+    lines = raw.strip().split('\n')
+    description = lines[1].strip() if len(lines) >= 2 else lines[0].strip()
+    description = _DESC_JUNK_RE.sub('', description)
+    return _WS_RE.sub(' ', description).strip()
 
-@dataclass
+
+@dataclass(frozen=True, slots=True)
 class BomItem:
     line_no: int
     description: str
@@ -35,170 +97,303 @@ class BomItem:
     qty: int
 
 
-def extract_items_from_pdf(pdf_path: str, start_page: int = 0) -> List[BomItem]:
+def _header_indexes(header):
+    """Map a table header row to (lv, desc, mat, qty) column indexes.
+
+    Single pass over the cells, stopping as soon as all four columns
+    are known; unmatched columns come back as None.
+    """
+    lv_idx = desc_idx = mat_idx = qty_idx = None
+    for i, cell in enumerate(header):
+        if not cell:
+            continue
+        tokens = frozenset(_cell_text(cell).upper().split())
+        if lv_idx is None and tokens & _LV_TOKENS:
+            lv_idx = i
+        elif desc_idx is None and tokens & _DESC_TOKENS:
+            desc_idx = i
+        elif mat_idx is None and tokens & _MAT_TOKENS:
+            mat_idx = i
+        elif qty_idx is None and 'AUTH' in tokens and 'QTY' in tokens:
+            qty_idx = i
+            if lv_idx is not None and desc_idx is not None and mat_idx is not None:
+                break
+    return lv_idx, desc_idx, mat_idx, qty_idx
+
+
+# BOM tables ship with ruling lines, so pin pdfplumber to the line
+# strategies explicitly; tune here if a vendor's BOMs need the
+# text-clustering strategy instead.
+TABLE_SETTINGS = {
+    'vertical_strategy': 'lines',
+    'horizontal_strategy': 'lines',
+    'snap_tolerance': 3,
+}
+
+
+def _iter_page_tables_pdfplumber(pdf_path, start_page):
+    with pdfplumber.open(pdf_path) as pdf:
+        pages = pdf.pages
+        for page_index in range(start_page, len(pages)):
+            page = pages[page_index]
+            yield page.extract_tables(table_settings=TABLE_SETTINGS)
+            page.flush_cache()
+
+
+def _iter_page_tables_pymupdf(pdf_path, start_page):
+    doc = pymupdf.open(pdf_path)
+    try:
+        for page in doc.pages(start_page):
+            yield [tab.extract() for tab in page.find_tables().tables]
+    finally:
+        doc.close()
+
+
+def _iter_page_tables(pdf_path, start_page):
+    """Yield each page's tables (lists of row lists), fastest backend first."""
+    if _HAS_PYMUPDF:
+        return _iter_page_tables_pymupdf(pdf_path, start_page)
+    return _iter_page_tables_pdfplumber(pdf_path, start_page)
+
+
+def extract_items_from_pdf(pdf_path: str, start_page: int = 0,
+                           max_items: Optional[int] = None,
+                           stop_after_empty_pages: int = 3) -> List[BomItem]:
+    """Extract B-level BOM items from a PDF.
+
+    Table extraction dominates the cost per page, so the page walk bails
+    out early: after `stop_after_empty_pages` consecutive pages that
+    held items before but yield none (BOM rows are contiguous in
+    practice), or once `max_items` items have been collected.
+    """
     items = []
-    
+    items_append = items.append
+    line_no = 0
+    consecutive_empty = 0
+
     try:
-        with pdfplumber.open(pdf_path) as pdf:
-            for page in pdf.pages[start_page:]:
-                tables = page.extract_tables()
+        for tables in _iter_page_tables(pdf_path, start_page):
+            found_before = len(items)
+
+            for table in tables:
+                if len(table) < 2:
+                    continue
                 
-                for table in tables:
-                    if len(table) < 2:
+                lv_idx, desc_idx, mat_idx, qty_idx = _header_indexes(table[0])
+
+                if lv_idx is None or desc_idx is None:
+                    continue
+                
+                for row in table[1:]:
+                    if not any(row):
                         continue
                     
-                    header = table[0]
-                    lv_idx = None
-                    desc_idx = None
-                    mat_idx = None
-                    qty_idx = None
+                    lv_cell = row[lv_idx] if lv_idx < len(row) else None
+                    # Most LV cells are exactly 'B'; only padded or
+                    # lower-case variants pay for strip/upper.
+                    if lv_cell != 'B':
+                        if not lv_cell or _cell_text(lv_cell).strip().upper() != 'B':
+                            continue
                     
-                    for i, cell in enumerate(header):
-                        if cell:
-                            text = str(cell).upper()
-                            if 'LV' in text or 'LEVEL' in text:
-                                lv_idx = i
-                            elif 'DESC' in text:
-                                desc_idx = i
-                            elif 'MATERIAL' in text:
-                                mat_idx = i
-                            elif 'AUTH' in text and 'QTY' in text:
-                                qty_idx = i
+                    desc_cell = row[desc_idx] if desc_idx < len(row) else None
+                    description = ""
+                    if desc_cell:
+                        description = _clean_description(_cell_text(desc_cell))
                     
-                    if lv_idx is None or desc_idx is None:
+                    if not description:
                         continue
                     
-                    for row in table[1:]:
-                        if not any(cell for cell in row if cell):
-                            continue
-                        
-                        lv_cell = row[lv_idx] if lv_idx < len(row) else None
-                        if not lv_cell or str(lv_cell).strip().upper() != 'B':
-                            continue
-                        
-                        desc_cell = row[desc_idx] if desc_idx < len(row) else None
-                        description = ""
-                        if desc_cell:
-                            lines = str(desc_cell).strip().split('\n')
-                            description = lines[1].strip() if len(lines) >= 2 else lines[0].strip()
-                            
-                            if '(' in description:
-                                description = description.split('(')[0].strip()
-                            
-                            description = re.sub(r'\s+(WTY|ARC|CIIC|UI|SCMC|EA|AY|9K|9G)$', '', description, flags=re.IGNORECASE)
-                            description = re.sub(r'\s+', ' ', description).strip()
-                        
-                        if not description:
-                            continue
-                        
-                        nsn = ""
-                        if mat_idx is not None and mat_idx < len(row):
-                            mat_cell = row[mat_idx]
-                            if mat_cell:
-                                match = re.search(r'\b(\d{9})\b', str(mat_cell))
+                    nsn = ""
+                    if mat_idx is not None and mat_idx < len(row):
+                        mat_cell = row[mat_idx]
+                        if mat_cell:
+                            mat_str = _cell_text(mat_cell)
+                            # Cells shorter than 9 chars can't hold an
+                            # NSN; skip the regex engine entirely.
+                            if len(mat_str) >= 9:
+                                match = _NSN_RE.search(mat_str)
                                 if match:
                                     nsn = match.group(1)
-                        
-                        # FIXED: Get quantity from Auth Qty column
-                        qty = 1
-                        if qty_idx is not None and qty_idx < len(row):
-                            qty_cell = row[qty_idx]
-                            if qty_cell:
-                                qty_str = str(qty_cell).strip()
-                                print(f"Qty raw: '{qty_str}'")
-                                match = re.search(r'(\d+)', qty_str)
+                    
+                    # FIXED: Get quantity from Auth Qty column
+                    qty = 1
+                    if qty_idx is not None and qty_idx < len(row):
+                        qty_cell = row[qty_idx]
+                        if qty_cell:
+                            qty_str = _cell_text(qty_cell).strip()
+                            # Most cells are a bare integer; only mixed
+                            # content falls back to the regex search.
+                            if qty_str.isdigit():
+                                qty = int(qty_str)
+                            else:
+                                match = _QTY_RE.search(qty_str)
                                 if match:
                                     qty = int(match.group(1))
-                                    print(f"Qty extracted: {qty}")
                                 else:
-                                    print(f"No number found in qty")
-                        
-                        items.append(BomItem(
-                            line_no=len(items) + 1,
-                            description=description[:100],
-                            nsn=nsn,
-                            qty=qty
-                        ))
-    
-    except Exception as e:
-        print(f"ERROR: {e}")
-        import traceback
-        traceback.print_exc()
+                                    logger.debug("no quantity in %r, defaulting to 1", qty_str)
+                    
+                    line_no += 1
+                    items_append(BomItem(
+                        line_no=line_no,
+                        description=description[:100],
+                        nsn=nsn,
+                        qty=qty
+                    ))
+
+                    if max_items is not None and line_no >= max_items:
+                        return items
+
+            if items:
+                if len(items) == found_before:
+                    consecutive_empty += 1
+                    if consecutive_empty >= stop_after_empty_pages:
+                        break
+                else:
+                    consecutive_empty = 0
+
+    except Exception:
+        logger.exception("BOM extraction failed for %s", pdf_path)
         return []
     
     return items
 
 
+@functools.lru_cache(maxsize=32)
+def _template_bytes_cached(template_path: str, mtime: float) -> bytes:
+    with open(template_path, 'rb') as f:
+        return f.read()
+
+
+def _read_template_bytes(template_path: str) -> bytes:
+    """Read a template PDF, memoized by (path, mtime).
+
+    The web app hands over content-addressed template paths, so repeat
+    generations against the same blank form skip the disk read.
+    """
+    return _template_bytes_cached(template_path, os.path.getmtime(template_path))
+
+
+# Overlay text is dominated by short repeating strings ("EA", "0",
+# quantities, line numbers); measure each (text, font, size) once.
+_string_width = functools.lru_cache(maxsize=4096)(pdfmetrics.stringWidth)
+
+
+def _write_blank_template(template_bytes: bytes, out_path: str) -> None:
+    """Write the first template page, untouched, as the whole output."""
+    writer = PdfWriter()
+    writer.add_page(PdfReader(io.BytesIO(template_bytes)).pages[0])
+    with open(out_path, 'wb', buffering=_WRITE_BUFFER_SIZE) as f:
+        writer.write(f)
+
+
 def generate_dd1750_from_pdf(bom_path: str, template_path: str, out_path: str, start_page: int = 0):
     try:
         items = extract_items_from_pdf(bom_path, start_page)
-        
-        print(f"\nItems found: {len(items)}")
-        
+
+        logger.info("%d items extracted from %s", len(items), bom_path)
+
+        # merge_page mutates the page it is called on, so each output
+        # page parses its own copy from the cached bytes instead of
+        # re-reading the file from disk.
+        template_bytes = _read_template_bytes(template_path)
+
         if not items:
-            reader = PdfReader(template_path)
-            writer = PdfWriter()
-            writer.add_page(reader.pages[0])
-            with open(out_path, 'wb') as f:
-                writer.write(f)
+            _write_blank_template(template_bytes, out_path)
             return out_path, 0
-        
-        total_pages = math.ceil(len(items) / ROWS_PER_PAGE)
-        writer = PdfWriter()
-        
+
+        total_pages = -(-len(items) // ROWS_PER_PAGE)
+
+        # All overlay pages share one Canvas (showPage between them), so
+        # canvas init and the overlay parse happen once, not per page.
+        # The overlay never leaves memory before pypdf re-serializes the
+        # merged result, so compressing its few KB per page is wasted
+        # zlib work on both ends.
+        overlay_buf = io.BytesIO()
+        can = canvas.Canvas(overlay_buf, pagesize=(PAGE_W, PAGE_H),
+                            pageCompression=0)
+
         for page_num in range(total_pages):
             start_idx = page_num * ROWS_PER_PAGE
             end_idx = min((page_num + 1) * ROWS_PER_PAGE, len(items))
             page_items = items[start_idx:end_idx]
-            
-            packet = io.BytesIO()
-            can = canvas.Canvas(packet, pagesize=(PAGE_W, PAGE_H))
-            
+
             first_row_top = Y_TABLE_TOP_LINE - 5.0
-            
-            for i, item in enumerate(page_items):
-                y = first_row_top - (i * ROW_H)
+
+            # Bucket the draws by font so each page emits one setFont
+            # per font instead of up to four state switches per row.
+            centred_8 = []
+            left_7 = []
+            left_6 = []
+
+            row_tops = [first_row_top - i * ROW_H for i in range(len(page_items))]
+
+            centred_add = centred_8.append
+            for item, y in zip(page_items, row_tops):
                 y_desc = y - 7.0
                 y_nsn = y - 12.2
-                
-                can.setFont("Helvetica", 8)
-                can.drawCentredString((X_BOX_L + X_BOX_R)/2, y_desc, str(item.line_no))
-                
-                can.setFont("Helvetica", 7)
-                desc = item.description[:50] if len(item.description) > 50 else item.description
-                can.drawString(X_CONTENT_L + PAD_X, y_desc, desc)
-                
+                qty = str(item.qty)
+
+                centred_add((X_BOX_C, y_desc, str(item.line_no)))
+                centred_add((X_UOI_C, y_desc, "EA"))
+                centred_add((X_INIT_C, y_desc, qty))
+                centred_add((X_SPARES_C, y_desc, "0"))
+                centred_add((X_TOTAL_C, y_desc, qty))
+
+                left_7.append((X_CONTENT_L + PAD_X, y_desc, item.description[:50]))
+
                 if item.nsn:
-                    can.setFont("Helvetica", 6)
-                    can.drawString(X_CONTENT_L + PAD_X, y_nsn, f"NSN: {item.nsn}")
-                
-                can.setFont("Helvetica", 8)
-                can.drawCentredString((X_UOI_L + X_UOI_R)/2, y_desc, "EA")
-                can.drawCentredString((X_INIT_L + X_INIT_R)/2, y_desc, str(item.qty))
-                can.drawCentredString((X_SPARES_L + X_SPARES_R)/2, y_desc, "0")
-                can.drawCentredString((X_TOTAL_L + X_TOTAL_R)/2, y_desc, str(item.qty))
-            
-            can.save()
-            packet.seek(0)
-            
-            overlay = PdfReader(packet)
-            page = PdfReader(template_path).pages[0]
-            page.merge_page(overlay.pages[0])
+                    left_6.append((X_CONTENT_L + PAD_X, y_nsn, f"NSN: {item.nsn}"))
+
+            # Each bucket goes out as one text object per font: a single
+            # BT/ET block instead of one per drawString. Centred strings
+            # are placed by hand from memoized widths, skipping
+            # drawCentredString's per-call measurement.
+            text_obj = can.beginText()
+            text_obj.setFont("Helvetica", 8)
+            set_origin, text_out = text_obj.setTextOrigin, text_obj.textOut
+            for x, y, text in centred_8:
+                set_origin(x - _string_width(text, "Helvetica", 8) / 2, y)
+                text_out(text)
+            can.drawText(text_obj)
+
+            for size, bucket in ((7, left_7), (6, left_6)):
+                if not bucket:
+                    continue
+                text_obj = can.beginText()
+                text_obj.setFont("Helvetica", size)
+                set_origin, text_out = text_obj.setTextOrigin, text_obj.textOut
+                for x, y, text in bucket:
+                    set_origin(x, y)
+                    text_out(text)
+                can.drawText(text_obj)
+
+            can.showPage()
+
+        can.save()
+        overlay_buf.seek(0)
+        overlay_reader = PdfReader(overlay_buf)
+
+        writer = PdfWriter()
+        for page_num in range(total_pages):
+            page = PdfReader(io.BytesIO(template_bytes)).pages[0]
+            page.merge_page(overlay_reader.pages[page_num])
             writer.add_page(page)
-        
-        with open(out_path, 'wb') as f:
+
+        # Every output page carries a copy of the template body; let
+        # newer pypdf serialize it once (no-op guard for the pinned
+        # 3.x, which lacks the method).
+        if hasattr(writer, 'compress_identical_objects'):
+            writer.compress_identical_objects()
+
+        with open(out_path, 'wb', buffering=_WRITE_BUFFER_SIZE) as f:
             writer.write(f)
         
         return out_path, len(items)
         
-    except Exception as e:
-        print(f"CRITICAL ERROR: {e}")
+    except Exception:
+        logger.exception("PDF generation failed, writing blank template")
         try:
-            reader = PdfReader(template_path)
-            writer = PdfWriter()
-            writer.add_page(reader.pages[0])
-            with open(out_path, 'wb') as f:
-                writer.write(f)
-        except:
+            _write_blank_template(_read_template_bytes(template_path), out_path)
+        except Exception:
             pass
         return out_path, 0
@@ -0,0 +1,26 @@
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8000)}"
+
+# PDF parse + render is CPU-bound, so scale by process, not thread.
+workers = (os.cpu_count() or 1) * 2 + 1
+worker_class = "sync"
+
+# Fork with the app (and the PDF libs) already imported so per-worker
+# memory is COW-shared.
+preload_app = True
+
+# Large BOMs can take a while to parse and render.
+timeout = 300
+
+# Recycle workers to bound any slow memory growth in the PDF libs.
+max_requests = 100
+max_requests_jitter = 10
+
+
+def post_fork(server, worker):
+    # With preload_app the import below is a no-op cache hit; it is the
+    # safety net for deployments that turn preloading off (e.g. --reload
+    # during development), so no worker ever pays pdfplumber/reportlab
+    # init inside its first request.
+    import dd1750_core  # noqa: F401